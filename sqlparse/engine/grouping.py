@@ -5,6 +5,9 @@
 # This module is part of python-sqlparse and is released under
 # the BSD License: https://opensource.org/licenses/BSD-3-Clause
 
+import threading
+from collections import OrderedDict
+
 from sqlparse import sql
 from sqlparse import tokens as T
 from sqlparse.utils import recurse, imt
@@ -13,18 +16,56 @@ T_NUMERICAL = (T.Number, T.Number.Integer, T.Number.Float)
 T_STRING = (T.String, T.String.Single, T.String.Symbol)
 T_NAME = (T.Name, T.Name.Placeholder)
 
+# Precomputed lookups for the valid_prev / valid_next predicates below.
+# Token types are compared for equality here (not for sub types), which
+# is what imt() does when given a tuple of token types.
+_T_PERIOD_PREV = frozenset((T.Name, T.String.Symbol))
+_I_PERIOD_PREV = (sql.SquareBrackets, sql.Identifier)
+_T_PERIOD_NEXT = frozenset((T.Name, T.String.Symbol, T.Wildcard))
+_I_PERIOD_NEXT = (sql.SquareBrackets, sql.Function)
+
+_T_COMPARABLE = frozenset(T_NUMERICAL + T_STRING + T_NAME)
+_I_COMPARABLE = (sql.Parenthesis, sql.Function, sql.Identifier,
+                 sql.Operation, sql.TypedLiteral)
+
+_T_IDENTIFIER_LIST = frozenset(T_NUMERICAL + T_STRING + T_NAME
+                               + (T.Keyword, T.Comment, T.Wildcard))
+_I_IDENTIFIER_LIST = (sql.Function, sql.Case, sql.Identifier,
+                      sql.Comparison, sql.IdentifierList, sql.Operation)
+
+_T_IDENTIFIER = frozenset((T.String.Symbol, T.Name))
+
+_T_ARRAY_PREV = frozenset((T.Name, T.String.Symbol))
+_I_ARRAY_PREV = (sql.SquareBrackets, sql.Identifier, sql.Function)
+
+_T_NOT_ALIASED = frozenset((T.DML, T.DDL, T.CTE))
+
+_T_OPERATOR = frozenset((T.Operator, T.Wildcard))
+_T_OPERAND = _T_COMPARABLE
+_I_OPERAND = (sql.SquareBrackets, sql.Parenthesis, sql.Function,
+              sql.Identifier, sql.Operation, sql.TypedLiteral)
+_M_OPERAND = T.Keyword, ('CURRENT_DATE', 'CURRENT_TIME', 'CURRENT_TIMESTAMP')
+
+# TokenLists whose _groupable_tokens leave out the first and last token
+_I_BRACKETED = (sql.Parenthesis, sql.SquareBrackets)
+
+_I_ALIAS = (sql.Parenthesis, sql.Function, sql.Case, sql.Identifier,
+            sql.Operation, sql.Comparison)
+
 
 def _group_matching(tlist, cls):
     """Groups Tokens that have beginning and end."""
     opens = []
-    tidx_offset = 0
-    for idx, token in enumerate(list(tlist)):
-        tidx = idx - tidx_offset
+    tokens = tlist.tokens
+    tidx = 0
+    while tidx < len(tokens):
+        token = tokens[tidx]
 
         if token.is_whitespace:
             # ~50% of tokens will be whitespace. Will checking early
             # for them avoid 3 comparisons, but then add 1 more comparison
             # for the other ~50% of tokens...
+            tidx += 1
             continue
 
         if token.is_group and not isinstance(token, cls):
@@ -32,6 +73,7 @@ def _group_matching(tlist, cls):
             # of different type is inside (i.e., case). though ideally  should
             # should check for all open/close tokens at once to avoid recursion
             _group_matching(token, cls)
+            tidx += 1
             continue
 
         if token.match(*cls.M_OPEN):
@@ -43,10 +85,13 @@ def _group_matching(tlist, cls):
             except IndexError:
                 # this indicates invalid sql and unbalanced tokens.
                 # instead of break, continue in case other "valid" groups exist
+                tidx += 1
                 continue
-            close_idx = tidx
-            tlist.group_tokens(cls, open_idx, close_idx)
-            tidx_offset += close_idx - open_idx
+            tlist.group_tokens(cls, open_idx, tidx)
+            # the new group now sits where the opening token was
+            tidx = open_idx
+
+        tidx += 1
 
 
 def group_brackets(tlist):
@@ -73,38 +118,148 @@ def group_begin(tlist):
     _group_matching(tlist, sql.Begin)
 
 
+def _match_keys(ttype, values):
+    """Returns (ttype, value) keys for a M_OPEN/M_CLOSE pattern.
+
+    Values are normalized the way Token.match() compares them, so a token
+    matches the pattern if (token.ttype, token.normalized) is a key.
+    """
+    if isinstance(values, str):
+        values = (values,)
+    if ttype in T.Keyword:
+        values = (v.upper() for v in values)
+    return [(ttype, value) for value in values]
+
+
+def _match_tables(classes):
+    opened_by = {}
+    closed_by = {}
+    for cls in classes:
+        for key in _match_keys(*cls.M_OPEN):
+            opened_by[key] = cls
+        for key in _match_keys(*cls.M_CLOSE):
+            closed_by[key] = closed_by.get(key, ()) + (cls,)
+    return opened_by, closed_by
+
+
+# Classes that are grouped by a pair of opening and closing tokens,
+# looked up by (ttype, normalized value) of the opening/closing token.
+_OPENED_BY, _CLOSED_BY = _match_tables(
+    (sql.SquareBrackets, sql.Parenthesis, sql.Case,
+     sql.If, sql.For, sql.Begin))
+
+
+def _group_matching_multi(tlist):
+    """Groups Tokens that have beginning and end for all classes at once.
+
+    Walks the token tree only once instead of once per class. A closing
+    token is paired with the nearest opening token it closes, unbalanced
+    opening tokens in between are left as is. For balanced SQL this is
+    the same as calling _group_matching for each class. With unbalanced
+    or interleaved pairs of different classes the result can differ,
+    e.g. "case ... begin ... end" groups the Begin and leaves CASE open.
+    """
+    # Build the new list of child tokens in one go instead of splicing
+    # tlist.tokens for each group: a closing token only ever wraps the
+    # tail of what has been collected so far.
+    # One stack of opening token indexes per class, so that unclosed
+    # opening tokens (e.g. T-SQL IF) don't have to be scanned over.
+    opens = {}
+    tokens = []
+    for token in tlist.tokens:
+        if token.is_whitespace:
+            tokens.append(token)
+            continue
+
+        if token.is_group:
+            _group_matching_multi(token)
+            tokens.append(token)
+            continue
+
+        key = token.ttype, token.normalized
+        cls = _OPENED_BY.get(key)
+        if cls is not None:
+            opens.setdefault(cls, []).append(len(tokens))
+            tokens.append(token)
+            continue
+
+        open_idx = -1
+        for cls in _CLOSED_BY.get(key, ()):
+            stack = opens.get(cls)
+            if stack and stack[-1] > open_idx:
+                open_idx, grp_cls = stack[-1], cls
+
+        if open_idx == -1:
+            tokens.append(token)
+            continue
+
+        # drop the opening token and any unbalanced ones inside the group
+        for stack in opens.values():
+            while stack and stack[-1] >= open_idx:
+                stack.pop()
+        grp = grp_cls(tokens[open_idx:] + [token])
+        grp.parent = tlist
+        tokens[open_idx:] = [grp]
+
+    tlist.tokens[:] = tokens
+
+
+def _valid_any(token):
+    return True
+
+
+def _valid_not_none(token):
+    return token is not None
+
+
+def _post_prev_to_next(tlist, pidx, tidx, nidx):
+    return pidx, nidx
+
+
+def _typecast_match(token):
+    return token.match(T.Punctuation, '::')
+
+
 def group_typecasts(tlist):
-    def match(token):
-        return token.match(T.Punctuation, '::')
+    _group(tlist, sql.Identifier, _typecast_match,
+           _valid_not_none, _valid_not_none, _post_prev_to_next)
+
 
-    def valid(token):
-        return token is not None
+def _tzcast_match(token):
+    return token.ttype == T.Keyword.TZCast
 
-    def post(tlist, pidx, tidx, nidx):
-        return pidx, nidx
 
-    valid_prev = valid_next = valid
-    _group(tlist, sql.Identifier, match, valid_prev, valid_next, post)
+def _tzcast_valid_next(token):
+    return token is not None and (
+        token.is_whitespace
+        or token.match(T.Keyword, 'AS')
+        or token.match(*sql.TypedLiteral.M_CLOSE)
+    )
 
 
 def group_tzcasts(tlist):
-    def match(token):
-        return token.ttype == T.Keyword.TZCast
+    _group(tlist, sql.Identifier, _tzcast_match,
+           _valid_not_none, _tzcast_valid_next, _post_prev_to_next)
+
+
+def _typed_literal_match(token):
+    return imt(token, m=sql.TypedLiteral.M_OPEN)
 
-    def valid_prev(token):
-        return token is not None
 
-    def valid_next(token):
-        return token is not None and (
-            token.is_whitespace
-            or token.match(T.Keyword, 'AS')
-            or token.match(*sql.TypedLiteral.M_CLOSE)
-        )
+def _typed_literal_match_to_extend(token):
+    return isinstance(token, sql.TypedLiteral)
 
-    def post(tlist, pidx, tidx, nidx):
-        return pidx, nidx
 
-    _group(tlist, sql.Identifier, match, valid_prev, valid_next, post)
+def _typed_literal_valid_next(token):
+    return token is not None and token.match(*sql.TypedLiteral.M_CLOSE)
+
+
+def _typed_literal_valid_final(token):
+    return token is not None and token.match(*sql.TypedLiteral.M_EXTEND)
+
+
+def _typed_literal_post(tlist, pidx, tidx, nidx):
+    return tidx, nidx
 
 
 def group_typed_literal(tlist):
@@ -113,273 +268,257 @@ def group_typed_literal(tlist):
     # https://docs.microsoft.com/en-us/sql/odbc/reference/appendixes/interval-literals
     # https://www.postgresql.org/docs/9.1/datatype-datetime.html
     # https://www.postgresql.org/docs/9.1/functions-datetime.html
-    def match(token):
-        return imt(token, m=sql.TypedLiteral.M_OPEN)
+    _group(tlist, sql.TypedLiteral, _typed_literal_match,
+           _valid_not_none, _typed_literal_valid_next,
+           _typed_literal_post, extend=False)
+    _group(tlist, sql.TypedLiteral, _typed_literal_match_to_extend,
+           _valid_not_none, _typed_literal_valid_final,
+           _typed_literal_post, extend=True)
+
 
-    def match_to_extend(token):
-        return isinstance(token, sql.TypedLiteral)
+def _period_match(token):
+    return token.match(T.Punctuation, '.')
 
-    def valid_prev(token):
-        return token is not None
 
-    def valid_next(token):
-        return token is not None and token.match(*sql.TypedLiteral.M_CLOSE)
+def _period_valid_prev(token):
+    return token is not None and (
+        token.ttype in _T_PERIOD_PREV or isinstance(token, _I_PERIOD_PREV))
 
-    def valid_final(token):
-        return token is not None and token.match(*sql.TypedLiteral.M_EXTEND)
 
-    def post(tlist, pidx, tidx, nidx):
-        return tidx, nidx
+def _period_post(tlist, pidx, tidx, nidx):
+    # next_ validation is being performed here. issue261
+    next_ = tlist[nidx] if nidx is not None else None
+    valid_next = next_ is not None and (
+        next_.ttype in _T_PERIOD_NEXT or isinstance(next_, _I_PERIOD_NEXT))
 
-    _group(tlist, sql.TypedLiteral, match, valid_prev, valid_next,
-           post, extend=False)
-    _group(tlist, sql.TypedLiteral, match_to_extend, valid_prev, valid_final,
-           post, extend=True)
+    return (pidx, nidx) if valid_next else (pidx, tidx)
 
 
 def group_period(tlist):
-    def match(token):
-        return token.match(T.Punctuation, '.')
+    # issue261, allow invalid next token
+    _group(tlist, sql.Identifier, _period_match,
+           _period_valid_prev, _valid_any, _period_post)
 
-    def valid_prev(token):
-        sqlcls = sql.SquareBrackets, sql.Identifier
-        ttypes = T.Name, T.String.Symbol
-        return imt(token, i=sqlcls, t=ttypes)
 
-    def valid_next(token):
-        # issue261, allow invalid next token
-        return True
+def _as_match(token):
+    return token.is_keyword and token.normalized == 'AS'
 
-    def post(tlist, pidx, tidx, nidx):
-        # next_ validation is being performed here. issue261
-        sqlcls = sql.SquareBrackets, sql.Function
-        ttypes = T.Name, T.String.Symbol, T.Wildcard
-        next_ = tlist[nidx] if nidx is not None else None
-        valid_next = imt(next_, i=sqlcls, t=ttypes)
 
-        return (pidx, nidx) if valid_next else (pidx, tidx)
+def _as_valid_prev(token):
+    return token.normalized == 'NULL' or not token.is_keyword
 
-    _group(tlist, sql.Identifier, match, valid_prev, valid_next, post)
 
+def _as_valid_next(token):
+    return token is not None and token.ttype not in _T_NOT_ALIASED
 
-def group_as(tlist):
-    def match(token):
-        return token.is_keyword and token.normalized == 'AS'
 
-    def valid_prev(token):
-        return token.normalized == 'NULL' or not token.is_keyword
+def group_as(tlist):
+    _group(tlist, sql.Identifier, _as_match,
+           _as_valid_prev, _as_valid_next, _post_prev_to_next)
 
-    def valid_next(token):
-        ttypes = T.DML, T.DDL, T.CTE
-        return not imt(token, t=ttypes) and token is not None
 
-    def post(tlist, pidx, tidx, nidx):
-        return pidx, nidx
+def _assignment_match(token):
+    return token.match(T.Assignment, ':=')
 
-    _group(tlist, sql.Identifier, match, valid_prev, valid_next, post)
 
+def _assignment_valid(token):
+    return token is not None and token.ttype not in (T.Keyword)
 
-def group_assignment(tlist):
-    def match(token):
-        return token.match(T.Assignment, ':=')
 
-    def valid(token):
-        return token is not None and token.ttype not in (T.Keyword)
+def _assignment_post(tlist, pidx, tidx, nidx):
+    m_semicolon = T.Punctuation, ';'
+    snidx, _ = tlist.token_next_by(m=m_semicolon, idx=nidx)
+    nidx = snidx or nidx
+    return pidx, nidx
 
-    def post(tlist, pidx, tidx, nidx):
-        m_semicolon = T.Punctuation, ';'
-        snidx, _ = tlist.token_next_by(m=m_semicolon, idx=nidx)
-        nidx = snidx or nidx
-        return pidx, nidx
 
-    valid_prev = valid_next = valid
-    _group(tlist, sql.Assignment, match, valid_prev, valid_next, post)
+def group_assignment(tlist):
+    valid_prev = valid_next = _assignment_valid
+    _group(tlist, sql.Assignment, _assignment_match,
+           valid_prev, valid_next, _assignment_post)
 
 
-def group_comparison(tlist):
-    sqlcls = (sql.Parenthesis, sql.Function, sql.Identifier,
-              sql.Operation, sql.TypedLiteral)
-    ttypes = T_NUMERICAL + T_STRING + T_NAME
+def _comparison_match(token):
+    return token.ttype == T.Operator.Comparison
 
-    def match(token):
-        return token.ttype == T.Operator.Comparison
 
-    def valid(token):
-        if imt(token, t=ttypes, i=sqlcls):
-            return True
-        elif token and token.is_keyword and token.normalized == 'NULL':
-            return True
-        else:
-            return False
+def _comparison_valid(token):
+    if token is None:
+        return False
+    elif token.ttype in _T_COMPARABLE or isinstance(token, _I_COMPARABLE):
+        return True
+    else:
+        return token.is_keyword and token.normalized == 'NULL'
 
-    def post(tlist, pidx, tidx, nidx):
-        return pidx, nidx
 
-    valid_prev = valid_next = valid
-    _group(tlist, sql.Comparison, match,
-           valid_prev, valid_next, post, extend=False)
+def group_comparison(tlist):
+    valid_prev = valid_next = _comparison_valid
+    _group(tlist, sql.Comparison, _comparison_match,
+           valid_prev, valid_next, _post_prev_to_next, extend=False)
 
 
 @recurse(sql.Identifier)
 def group_identifier(tlist):
-    ttypes = (T.String.Symbol, T.Name)
+    for tidx, token in enumerate(tlist.tokens):
+        if token.ttype in _T_IDENTIFIER:
+            # replaces the token in place, the list keeps its length
+            tlist.group_tokens(sql.Identifier, tidx, tidx)
 
-    tidx, token = tlist.token_next_by(t=ttypes)
-    while token:
-        tlist.group_tokens(sql.Identifier, tidx, tidx)
-        tidx, token = tlist.token_next_by(t=ttypes, idx=tidx)
 
+def _array_match(token):
+    return isinstance(token, sql.SquareBrackets)
 
-def group_arrays(tlist):
-    sqlcls = sql.SquareBrackets, sql.Identifier, sql.Function
-    ttypes = T.Name, T.String.Symbol
 
-    def match(token):
-        return isinstance(token, sql.SquareBrackets)
+def _array_valid_prev(token):
+    return token is not None and (
+        token.ttype in _T_ARRAY_PREV or isinstance(token, _I_ARRAY_PREV))
 
-    def valid_prev(token):
-        return imt(token, i=sqlcls, t=ttypes)
 
-    def valid_next(token):
-        return True
+def _array_post(tlist, pidx, tidx, nidx):
+    return pidx, tidx
 
-    def post(tlist, pidx, tidx, nidx):
-        return pidx, tidx
 
-    _group(tlist, sql.Identifier, match,
-           valid_prev, valid_next, post, extend=True, recurse=False)
+def group_arrays(tlist):
+    _group(tlist, sql.Identifier, _array_match,
+           _array_valid_prev, _valid_any, _array_post,
+           extend=True, recurse=False)
 
 
-def group_operator(tlist):
-    ttypes = T_NUMERICAL + T_STRING + T_NAME
-    sqlcls = (sql.SquareBrackets, sql.Parenthesis, sql.Function,
-              sql.Identifier, sql.Operation, sql.TypedLiteral)
+def _operator_match(token):
+    return token.ttype in _T_OPERATOR
 
-    def match(token):
-        return imt(token, t=(T.Operator, T.Wildcard))
 
-    def valid(token):
-        return imt(token, i=sqlcls, t=ttypes) \
-            or (token and token.match(
-                T.Keyword,
-                ('CURRENT_DATE', 'CURRENT_TIME', 'CURRENT_TIMESTAMP')))
+def _operator_valid(token):
+    return token is not None and (
+        token.ttype in _T_OPERAND
+        or isinstance(token, _I_OPERAND)
+        or token.match(*_M_OPERAND))
 
-    def post(tlist, pidx, tidx, nidx):
-        tlist[tidx].ttype = T.Operator
-        return pidx, nidx
 
-    valid_prev = valid_next = valid
-    _group(tlist, sql.Operation, match,
-           valid_prev, valid_next, post, extend=False)
+def _operator_post(tlist, pidx, tidx, nidx):
+    tlist[tidx].ttype = T.Operator
+    return pidx, nidx
 
 
-def group_identifier_list(tlist):
-    m_role = T.Keyword, ('null', 'role')
-    sqlcls = (sql.Function, sql.Case, sql.Identifier, sql.Comparison,
-              sql.IdentifierList, sql.Operation)
-    ttypes = (T_NUMERICAL + T_STRING + T_NAME
-              + (T.Keyword, T.Comment, T.Wildcard))
+def group_operator(tlist):
+    valid_prev = valid_next = _operator_valid
+    _group(tlist, sql.Operation, _operator_match,
+           valid_prev, valid_next, _operator_post, extend=False)
 
-    def match(token):
-        return token.match(T.Punctuation, ',')
 
-    def valid(token):
-        return imt(token, i=sqlcls, m=m_role, t=ttypes)
+def _identifier_list_match(token):
+    return token.match(T.Punctuation, ',')
 
-    def post(tlist, pidx, tidx, nidx):
-        return pidx, nidx
 
-    valid_prev = valid_next = valid
-    _group(tlist, sql.IdentifierList, match,
-           valid_prev, valid_next, post, extend=True)
+def _identifier_list_valid(token):
+    # NULL and ROLE keywords are covered by T.Keyword
+    return token is not None and (
+        token.ttype in _T_IDENTIFIER_LIST
+        or isinstance(token, _I_IDENTIFIER_LIST))
+
+
+def group_identifier_list(tlist):
+    valid_prev = valid_next = _identifier_list_valid
+    _group(tlist, sql.IdentifierList, _identifier_list_match,
+           valid_prev, valid_next, _post_prev_to_next, extend=True)
 
 
 @recurse(sql.Comment)
 def group_comments(tlist):
-    tidx, token = tlist.token_next_by(t=T.Comment)
-    while token:
-        eidx, end = tlist.token_not_matching(
-            lambda tk: imt(tk, t=T.Comment) or tk.is_whitespace, idx=tidx)
-        if end is not None:
-            eidx, end = tlist.token_prev(eidx, skip_ws=False)
-            tlist.group_tokens(sql.Comment, tidx, eidx)
-
-        tidx, token = tlist.token_next_by(t=T.Comment, idx=tidx)
+    tidx = 0
+    while tidx < len(tlist.tokens):
+        if tlist.tokens[tidx].ttype in T.Comment:
+            eidx = tidx + 1
+            while eidx < len(tlist.tokens) and (
+                    tlist.tokens[eidx].ttype in T.Comment
+                    or tlist.tokens[eidx].is_whitespace):
+                eidx += 1
+            if eidx == len(tlist.tokens):
+                # only comments and whitespace left, nothing to group
+                break
+            tlist.group_tokens(sql.Comment, tidx, eidx - 1)
+        tidx += 1
 
 
 @recurse(sql.Where)
 def group_where(tlist):
-    tidx, token = tlist.token_next_by(m=sql.Where.M_OPEN)
-    while token:
-        eidx, end = tlist.token_next_by(m=sql.Where.M_CLOSE, idx=tidx)
-
-        if end is None:
-            end = tlist._groupable_tokens[-1]
-        else:
-            end = tlist.tokens[eidx - 1]
-        # TODO: convert this to eidx instead of end token.
-        # i think above values are len(tlist) and eidx-1
-        eidx = tlist.token_index(end)
-        tlist.group_tokens(sql.Where, tidx, eidx)
-        tidx, token = tlist.token_next_by(m=sql.Where.M_OPEN, idx=tidx)
+    tidx = 0
+    while tidx < len(tlist.tokens):
+        if tlist.tokens[tidx].match(*sql.Where.M_OPEN):
+            eidx, end = tlist.token_next_by(m=sql.Where.M_CLOSE, idx=tidx)
+
+            if end is None:
+                # up to the last groupable token, i.e. the last one or the
+                # one before the closing parenthesis/bracket
+                eidx = len(tlist.tokens) - 1
+                if isinstance(tlist, _I_BRACKETED):
+                    eidx -= 1
+            else:
+                eidx -= 1
+            tlist.group_tokens(sql.Where, tidx, eidx)
+        tidx += 1
 
 
 @recurse()
 def group_aliased(tlist):
-    I_ALIAS = (sql.Parenthesis, sql.Function, sql.Case, sql.Identifier,
-               sql.Operation, sql.Comparison)
-
-    tidx, token = tlist.token_next_by(i=I_ALIAS, t=T.Number)
-    while token:
-        nidx, next_ = tlist.token_next(tidx)
-        if isinstance(next_, sql.Identifier):
-            tlist.group_tokens(sql.Identifier, tidx, nidx, extend=True)
-        tidx, token = tlist.token_next_by(i=I_ALIAS, t=T.Number, idx=tidx)
+    tidx = 0
+    while tidx < len(tlist.tokens):
+        token = tlist.tokens[tidx]
+        if isinstance(token, _I_ALIAS) or token.ttype in T.Number:
+            nidx, next_ = tlist.token_next(tidx)
+            if isinstance(next_, sql.Identifier):
+                tlist.group_tokens(sql.Identifier, tidx, nidx, extend=True)
+        tidx += 1
 
 
 @recurse(sql.Function)
 def group_functions(tlist):
     has_create = False
     has_table = False
-    has_as = False
     for tmp_token in tlist.tokens:
-        if tmp_token.value.upper() == 'CREATE':
+        if tmp_token.value == 'AS':
+            # CREATE TABLE ... AS is grouped anyway, no need to look further
+            break
+        value = tmp_token.value.upper()
+        if value == 'CREATE':
             has_create = True
-        if tmp_token.value.upper() == 'TABLE':
+        elif value == 'TABLE':
             has_table = True
-        if tmp_token.value == 'AS':
-            has_as = True
-    if has_create and has_table and not has_as:
-        return
+    else:
+        if has_create and has_table:
+            return
 
-    tidx, token = tlist.token_next_by(t=T.Name)
-    while token:
-        nidx, next_ = tlist.token_next(tidx)
-        if isinstance(next_, sql.Parenthesis):
-            tlist.group_tokens(sql.Function, tidx, nidx)
-        tidx, token = tlist.token_next_by(t=T.Name, idx=tidx)
+    tidx = 0
+    while tidx < len(tlist.tokens):
+        if tlist.tokens[tidx].ttype in T.Name:
+            nidx, next_ = tlist.token_next(tidx)
+            if isinstance(next_, sql.Parenthesis):
+                tlist.group_tokens(sql.Function, tidx, nidx)
+        tidx += 1
 
 
 def group_order(tlist):
     """Group together Identifier and Asc/Desc token"""
-    tidx, token = tlist.token_next_by(t=T.Keyword.Order)
-    while token:
-        pidx, prev_ = tlist.token_prev(tidx)
-        if imt(prev_, i=sql.Identifier, t=T.Number):
-            tlist.group_tokens(sql.Identifier, pidx, tidx)
-            tidx = pidx
-        tidx, token = tlist.token_next_by(t=T.Keyword.Order, idx=tidx)
+    tidx = 0
+    while tidx < len(tlist.tokens):
+        if tlist.tokens[tidx].ttype in T.Keyword.Order:
+            pidx, prev_ = tlist.token_prev(tidx)
+            if imt(prev_, i=sql.Identifier, t=T.Number):
+                tlist.group_tokens(sql.Identifier, pidx, tidx)
+                tidx = pidx
+        tidx += 1
 
 
 @recurse()
 def align_comments(tlist):
-    tidx, token = tlist.token_next_by(i=sql.Comment)
-    while token:
-        pidx, prev_ = tlist.token_prev(tidx)
-        if isinstance(prev_, sql.TokenList):
-            tlist.group_tokens(sql.TokenList, pidx, tidx, extend=True)
-            tidx = pidx
-        tidx, token = tlist.token_next_by(i=sql.Comment, idx=tidx)
+    tidx = 0
+    while tidx < len(tlist.tokens):
+        if isinstance(tlist.tokens[tidx], sql.Comment):
+            pidx, prev_ = tlist.token_prev(tidx)
+            if isinstance(prev_, sql.TokenList):
+                tlist.group_tokens(sql.TokenList, pidx, tidx, extend=True)
+                tidx = pidx
+        tidx += 1
 
 
 def group_values(tlist):
@@ -394,71 +533,192 @@ def group_values(tlist):
         tlist.group_tokens(sql.Values, start_idx, end_idx, extend=True)
 
 
+# Order of the grouping passes in _GROUPING_PASSES. Each pass relies on
+# groups built by earlier ones, so keep these in mind when reordering:
+#
+# - comments and matching pairs (brackets, parenthesis, CASE, ...) go
+#   first, they collapse the most tokens for all later passes.
+# - group_functions needs Parenthesis and bare T.Name tokens, so it runs
+#   before group_period/group_identifier wrap names into Identifiers.
+# - group_where needs Parenthesis to stop at the end of a subquery.
+# - group_period, then group_arrays, then group_identifier: arrays extend
+#   dotted names, group_identifier wraps whatever names are left.
+# - group_order needs the Identifier in front of ASC/DESC.
+# - typecasts, tzcasts and typed literals are operands of
+#   group_operator, Operations are operands of group_comparison.
+# - group_as and group_aliased attach aliases to all of the above.
+# - align_comments attaches comments to the preceding group before
+#   group_identifier_list collects the list items.
+# - group_values groups the parenthesis following VALUES at last.
+#
+# Each pass is listed with the token types and keyword/punctuation
+# values it needs to find in a statement to do anything at all. Passes
+# without any of them in the statement are skipped, None means the pass
+# is always run. Listing too much here is harmless, missing something
+# is not.
+_GROUPING_PASSES = [
+    (group_comments, {T.Comment}, ()),
+
+    # brackets, parenthesis, case, if, for, begin
+    (_group_matching_multi, (), {value for _, value in _OPENED_BY}),
+
+    (group_functions, (), {'('}),
+    (group_where, (), {'WHERE'}),
+    (group_period, (), {'.'}),
+    (group_arrays, (), {'['}),
+    (group_identifier, _T_IDENTIFIER, ()),
+    (group_order, {T.Keyword.Order}, ()),
+    (group_typecasts, (), {'::'}),
+    (group_tzcasts, {T.Keyword.TZCast}, ()),
+    (group_typed_literal, {T.Name.Builtin}, {'TIMESTAMP'}),
+    (group_operator, _T_OPERATOR, ()),
+    (group_comparison, {T.Operator.Comparison}, ()),
+    (group_as, (), {'AS'}),
+    (group_aliased, None, None),
+    (group_assignment, {T.Assignment}, ()),
+
+    (align_comments, {T.Comment}, ()),
+    (group_identifier_list, (), {','}),
+    (group_values, (), {'VALUES'}),
+]
+
+
+def _token_kinds(tlist):
+    """Returns the token types and keyword/punctuation values in *tlist*.
+
+    The token types include all their parent types, i.e. T.Comment for a
+    T.Comment.Single token.
+    """
+    ttypes = set()
+    values = set()
+    for token in tlist.flatten():
+        ttypes.add(token.ttype)
+        if token.is_keyword or token.ttype is T.Punctuation:
+            values.add(token.normalized)
+    for ttype in list(ttypes):
+        ttype = ttype.parent
+        while ttype is not None and ttype not in ttypes:
+            ttypes.add(ttype)
+            ttype = ttype.parent
+    return ttypes, values
+
+
 def group(stmt):
-    for func in [
-        group_comments,
-
-        # _group_matching
-        group_brackets,
-        group_parenthesis,
-        group_case,
-        group_if,
-        group_for,
-        group_begin,
-
-        group_functions,
-        group_where,
-        group_period,
-        group_arrays,
-        group_identifier,
-        group_order,
-        group_typecasts,
-        group_tzcasts,
-        group_typed_literal,
-        group_operator,
-        group_comparison,
-        group_as,
-        group_aliased,
-        group_assignment,
-
-        align_comments,
-        group_identifier_list,
-        group_values,
-    ]:
-        func(stmt)
+    ttypes, values = _token_kinds(stmt)
+    for func, needs_ttypes, needs_values in _GROUPING_PASSES:
+        if (needs_ttypes is None
+                or not ttypes.isdisjoint(needs_ttypes)
+                or not values.isdisjoint(needs_values)):
+            func(stmt)
+    return stmt
+
+
+_GROUP_CACHE = OrderedDict()
+_GROUP_CACHE_LOCK = threading.Lock()
+
+
+def _copy_tree(token, parent=None):
+    """Copy a grouped token tree without going through Token.__init__."""
+    new = object.__new__(type(token))
+    new.value = token.value
+    new.ttype = token.ttype
+    new.parent = parent
+    new.normalized = token.normalized
+    new.is_keyword = token.is_keyword
+    new.is_group = token.is_group
+    new.is_whitespace = token.is_whitespace
+    if token.is_group:
+        new.tokens = [_copy_tree(child, new) for child in token.tokens]
+    return new
+
+
+def group_cached(stmt, *, maxsize=1024):
+    """Same as group(), but reuses the result for recurring statements.
+
+    Like group(), *stmt* is grouped in place and returned. Statements are
+    considered equal when they consist of the same token types and
+    values. On a hit *stmt* gets a copy of the cached tree, so it can be
+    modified freely.
+
+    There is one cache for the whole module. At most *maxsize* statements
+    are kept in it, the least recently used ones are dropped first. So a
+    call with a small *maxsize* also drops entries stored by other
+    callers. A negative *maxsize* is treated as 0, like
+    functools.lru_cache does.
+    """
+    maxsize = max(maxsize, 0)
+    key = tuple((token.ttype, token.value) for token in stmt.flatten())
+    with _GROUP_CACHE_LOCK:
+        cached = _GROUP_CACHE.get(key)
+        if cached is not None:
+            _GROUP_CACHE.move_to_end(key)
+    # cached trees are never modified, copying them needs no lock
+    if cached is not None:
+        stmt.tokens[:] = [_copy_tree(token, stmt) for token in cached.tokens]
+        return stmt
+
+    stmt = group(stmt)
+    cached = _copy_tree(stmt)
+    with _GROUP_CACHE_LOCK:
+        _GROUP_CACHE[key] = cached
+        while len(_GROUP_CACHE) > maxsize:
+            _GROUP_CACHE.popitem(last=False)
     return stmt
 
 
 def _group(tlist, cls, match,
-           valid_prev=lambda t: True,
-           valid_next=lambda t: True,
+           valid_prev=_valid_any,
+           valid_next=_valid_any,
            post=None,
            extend=True,
            recurse=True
            ):
     """Groups together tokens that are joined by a middle token. i.e. x < y"""
 
-    tidx_offset = 0
+    # group_tokens() changes this list in place, so it stays valid
+    tokens = tlist.tokens
+    tidx = 0
     pidx, prev_ = None, None
-    for idx, token in enumerate(list(tlist)):
-        tidx = idx - tidx_offset
-        if tidx < 0:  # tidx shouldn't get negative
-            continue
+    while tidx < len(tokens):
+        token = tokens[tidx]
 
         if token.is_whitespace:
+            tidx += 1
             continue
 
         if recurse and token.is_group and not isinstance(token, cls):
             _group(token, cls, match, valid_prev, valid_next, post, extend)
 
         if match(token):
-            nidx, next_ = tlist.token_next(tidx)
+            # same as tlist.token_next(tidx), without the matcher overhead
+            nidx = tidx + 1
+            while nidx < len(tokens) and tokens[nidx].is_whitespace:
+                nidx += 1
+            if nidx < len(tokens):
+                next_ = tokens[nidx]
+            else:
+                nidx, next_ = None, None
             if prev_ and valid_prev(prev_) and valid_next(next_):
                 from_idx, to_idx = post(tlist, pidx, tidx, nidx)
                 grp = tlist.group_tokens(cls, from_idx, to_idx, extend=extend)
 
-                tidx_offset += to_idx - from_idx
                 pidx, prev_ = from_idx, grp
+                # Tokens after the match that were pulled into the group
+                # are still visited: nested groups get recursed into and
+                # the last one becomes prev_ (e.g. a = b = c). They are
+                # not matched again.
+                absorbed = to_idx - tidx
+                if absorbed > 0:
+                    for token in grp.tokens[-absorbed:]:
+                        if token.is_whitespace:
+                            continue
+                        if (recurse and token.is_group
+                                and not isinstance(token, cls)):
+                            _group(token, cls, match, valid_prev, valid_next,
+                                   post, extend)
+                        prev_ = token
+                tidx = from_idx + 1
                 continue
 
         pidx, prev_ = tidx, token
+        tidx += 1
@@ -68,10 +68,17 @@ def recurse(*cls):
     """
     def wrap(f):
         def wrapped_f(tlist):
-            for sgroup in tlist.get_sublists():
-                if not isinstance(sgroup, cls):
-                    wrapped_f(sgroup)
-            f(tlist)
+            # Walk the tree with an explicit stack instead of recursive
+            # calls and apply f bottom-up (children before their parent).
+            todo = deque([tlist])
+            order = []
+            while todo:
+                token = todo.pop()
+                order.append(token)
+                todo.extend(sgroup for sgroup in token.get_sublists()
+                            if not isinstance(sgroup, cls))
+            for token in reversed(order):
+                f(token)
 
         return wrapped_f
 
@@ -86,17 +93,15 @@ def imt(token, i=None, m=None, t=None):
     :param t: TokenType or Tuple/List of TokenTypes
     :return:  bool
     """
-    clss = i
-    types = [t, ] if t and not isinstance(t, list) else t
-    mpatterns = [m, ] if m and not isinstance(m, list) else m
-
     if token is None:
         return False
-    elif clss and isinstance(token, clss):
+    elif i and isinstance(token, i):
         return True
-    elif mpatterns and any(token.match(*pattern) for pattern in mpatterns):
+    elif m and (any(token.match(*pattern) for pattern in m)
+                if isinstance(m, list) else token.match(*m)):
         return True
-    elif types and any(token.ttype in ttype for ttype in types):
+    elif t and (any(token.ttype in ttype for ttype in t)
+                if isinstance(t, list) else token.ttype in t):
         return True
     else:
         return False
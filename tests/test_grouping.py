@@ -17,6 +17,80 @@ def test_grouping_parenthesis():
     assert len(parsed.tokens[2].tokens[3].tokens) == 3
 
 
+def test_grouping_matching_nested_mixed():
+    s = 'select case when (a[1]) then b end from t'
+    parsed = sqlparse.parse(s)[0]
+    assert str(parsed) == s
+    case = parsed.tokens[2]
+    assert isinstance(case, sql.Case)
+    assert case.tokens[-1].normalized == 'END'
+    paren = case.tokens[4]
+    assert isinstance(paren, sql.Parenthesis)
+    assert isinstance(paren.tokens[2], sql.SquareBrackets)
+
+
+def test_grouping_matching_nearest_close():
+    # END closes the nearest of CASE and BEGIN, the CASE stays open
+    s = 'case 1 select current_date begin is * end'
+    parsed = sqlparse.parse(s)[0]
+    assert str(parsed) == s
+    assert parsed.tokens[0].normalized == 'CASE'
+    assert not isinstance(parsed.tokens[0], sql.Case)
+    begin = parsed.tokens[-1]
+    assert isinstance(begin, sql.Begin)
+    assert begin.tokens[0].normalized == 'BEGIN'
+    assert begin.tokens[-1].normalized == 'END'
+    assert not any(isinstance(tk, sql.Case) for tk in parsed.get_sublists())
+
+
+def test_grouping_matching_unclosed_if():
+    # MySQL's if() looks like an IF without END IF to the parser. All of
+    # them stay open while the parenthesis after them are still grouped.
+    n = 2000
+    s = 'select ' + ', '.join('if (c{}, 1, 0)'.format(i) for i in range(n))
+    parsed = sqlparse.parse(s)[0]
+    assert str(parsed) == s
+    assert len(parsed.tokens) == 2 + 5 * n - 2
+    keywords = parsed.tokens[2::5]
+    parens = parsed.tokens[4::5]
+    assert all(tk.normalized == 'IF' for tk in keywords)
+    assert all(isinstance(tk, sql.Parenthesis) for tk in parens)
+    assert len(parens) == n
+
+
+def test_grouping_chained_typecasts():
+    s = 'a::b::c'
+    parsed = sqlparse.parse(s)[0]
+    assert str(parsed) == s
+    assert len(parsed.tokens) == 1
+    ident = parsed.tokens[0]
+    assert isinstance(ident, sql.Identifier)
+    assert [tk.value for tk in ident.tokens] == ['a', '::', 'b', '::', 'c']
+
+
+def test_grouping_chained_comparison():
+    s = 'a = b = c'
+    parsed = sqlparse.parse(s)[0]
+    assert len(parsed.tokens) == 1
+    outer = parsed.tokens[0]
+    assert isinstance(outer, sql.Comparison)
+    assert isinstance(outer.tokens[0], sql.Comparison)
+    assert str(outer.tokens[0]) == 'a = b'
+    assert str(outer.tokens[-1]) == 'c'
+
+
+def test_grouping_absorbed_token_not_matched_again():
+    # The second '::' is pulled into the typecast as its right side, it
+    # doesn't start another typecast that would take the '=' as well.
+    s = 'asc :: :: = end for'
+    parsed = sqlparse.parse(s)[0]
+    assert str(parsed) == s
+    ident = parsed.tokens[0]
+    assert isinstance(ident, sql.Identifier)
+    assert str(ident) == 'asc :: ::'
+    assert parsed.tokens[2].ttype is T.Operator.Comparison
+
+
 def test_grouping_comments():
     s = '/*\n * foo\n */   \n  bar'
     parsed = sqlparse.parse(s)[0]
@@ -654,3 +728,38 @@ def test_grouping_as_cte():
 def test_grouping_create_table():
     p = sqlparse.parse("create table db.tbl (a string)")[0].tokens
     assert p[4].value == "db.tbl"
+
+
+def test_group_cached(monkeypatch):
+    from collections import OrderedDict
+    from sqlparse.engine import FilterStack, grouping
+
+    def statement(s):
+        return next(FilterStack().run(s))
+
+    monkeypatch.setattr(grouping, '_GROUP_CACHE', OrderedDict())
+    s = 'select a, b from foo where c = 1'
+    first = grouping.group_cached(statement(s), maxsize=2)
+    second = grouping.group_cached(statement(s), maxsize=2)
+    assert str(second) == s
+    assert [type(t) for t in second.tokens] == [type(t) for t in first.tokens]
+    assert second.tokens[0].ttype is T.DML
+    where = second.tokens[-1]
+    assert isinstance(where, sql.Where)
+    assert where is not first.tokens[-1]
+    assert where.parent is second
+
+    # a hit groups the given statement in place, like group() does
+    third = statement(s)
+    assert grouping.group_cached(third, maxsize=2) is third
+    assert isinstance(third.tokens[-1], sql.Where)
+    assert third.tokens[-1].parent is third
+    assert str(third) == s
+
+    grouping.group_cached(statement('select 1'), maxsize=2)
+    grouping.group_cached(statement('select 2'), maxsize=2)
+    assert len(grouping._GROUP_CACHE) == 2
+
+    stmt = grouping.group_cached(statement(s), maxsize=-1)
+    assert isinstance(stmt.tokens[-1], sql.Where)
+    assert len(grouping._GROUP_CACHE) == 0
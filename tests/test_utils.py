@@ -1,6 +1,9 @@
+import sys
+
 import pytest
 
-from sqlparse import utils
+import sqlparse
+from sqlparse import sql, tokens as T, utils
 
 
 @pytest.mark.parametrize('value, expected', (
@@ -10,3 +13,41 @@ from sqlparse import utils
     ['`foo`', 'foo']))
 def test_remove_quotes(value, expected):
     assert utils.remove_quotes(value) == expected
+
+
+def test_recurse_bottom_up():
+    seen = []
+
+    @utils.recurse(sql.Function)
+    def visit(tlist):
+        seen.append(str(tlist))
+
+    visit(sqlparse.parse('select f(a), (b), c.d')[0])
+    assert seen == ['b', '(b)', 'c.d', 'select f(a), (b), c.d']
+
+
+def test_recurse_deep_nesting():
+    depth = sys.getrecursionlimit() + 100
+    stmt = sql.Statement([sql.Token(T.Name, 'x')])
+    for _ in range(depth):
+        parent = sql.Statement()
+        parent.tokens = [stmt]
+        stmt = parent
+    seen = []
+    utils.recurse()(seen.append)(stmt)
+    assert len(seen) == depth + 1
+
+
+@pytest.mark.parametrize('kwargs, expected', [
+    ({'i': sql.Identifier}, False),
+    ({'i': (sql.Identifier, sql.Token)}, True),
+    ({'m': (T.Keyword, 'SELECT')}, False),
+    ({'m': [(T.Keyword, 'SELECT'), (T.Name, 'foo')]}, True),
+    ({'t': T.Name}, True),
+    ({'t': (T.Keyword, T.Name.Builtin)}, False),
+    ({'t': [T.Keyword, T.Name]}, True),
+])
+def test_imt(kwargs, expected):
+    token = sql.Token(T.Name, 'foo')
+    assert utils.imt(token, **kwargs) is expected
+    assert utils.imt(None, **kwargs) is False